@@ -1,38 +1,79 @@
 import argparse
+import codecs
 import csv
-import io
 import json
 import os
 import sys
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 BASE = "https://huggingface.co/datasets/hendrycks/ethics/resolve/main/data"
+WRITE_BATCH = 1024  # records buffered before each write()
 
+# json.dump streams through the pure-Python iterencode in small chunks;
+# encode() takes the C fast path and returns the whole line at once
+encode = json.JSONEncoder(ensure_ascii=False).encode
 
-def select_commonsense(row):
-    text = row.get("input") or row.get("text") or row.get("scenario") or ""
-    return {"text": text, "label": int(row["label"])}
 
+# Selectors take the header's {name: index} map once and return a function
+# that builds the record from a positional row, so no dict is built per row.
+# Reads go through field(), which gives the same values csv.DictReader did.
 
-def select_deontology(row):
-    return {"scenario": row.get("scenario", "") or row.get("text", ""),
-            "label": int(row["label"]),
-            "excuse": row.get("excuse", "")}
+def field(row, idx, default=""):
+    # a column missing from the header reads as `default` (dict.get); a cell
+    # missing from a short row reads as None (DictReader's restval)
+    if idx is None:
+        return default
+    return row[idx] if idx < len(row) else None
 
 
-def select_justice(row):
-    return {"scenario": row.get("scenario", "") or row.get("text", ""),
-            "label": int(row["label"])}
+def select_commonsense(col):
+    inp, text, scenario = col.get("input"), col.get("text"), col.get("scenario")
+    label = col.get("label")
 
+    def select(row):
+        return {"text": field(row, inp, None) or field(row, text, None)
+                or field(row, scenario, None) or "",
+                "label": int(field(row, label))}
+    return select
 
-def select_utilitarianism(row):
+
+def select_deontology(col):
+    scenario, text, label = col.get("scenario"), col.get("text"), col.get("label")
+    excuse = col.get("excuse")
+
+    def select(row):
+        return {"scenario": field(row, scenario) or field(row, text),
+                "label": int(field(row, label)),
+                "excuse": field(row, excuse)}
+    return select
+
+
+def select_justice(col):
+    scenario, text, label = col.get("scenario"), col.get("text"), col.get("label")
+
+    def select(row):
+        return {"scenario": field(row, scenario) or field(row, text),
+                "label": int(field(row, label))}
+    return select
+
+
+def select_utilitarianism(col):
     # headers: baseline,less_pleasant
-    return {"baseline": row.get("baseline", ""), "less_pleasant": row.get("less_pleasant", "")}
+    baseline, less_pleasant = col.get("baseline"), col.get("less_pleasant")
+
+    def select(row):
+        return {"baseline": field(row, baseline), "less_pleasant": field(row, less_pleasant)}
+    return select
+
 
+def select_virtue(col):
+    scenario, text, label = col.get("scenario"), col.get("text"), col.get("label")
 
-def select_virtue(row):
-    return {"scenario": row.get("scenario", "") or row.get("text", ""),
-            "label": int(row["label"])}
+    def select(row):
+        return {"scenario": field(row, scenario) or field(row, text),
+                "label": int(field(row, label))}
+    return select
 
 
 SELECTORS = {
@@ -45,24 +86,34 @@ SELECTORS = {
 
 
 def stream_csv(url):
-    # decode once, preserve quoted commas and newlines
+    # decode incrementally so parsing overlaps the download
     with urllib.request.urlopen(url) as r:
-        text = r.read().decode("utf-8", errors="replace")
-    # DictReader handles headers and quoting
-    yield from csv.DictReader(io.StringIO(text))
+        # csv.reader handles quoting, incl. newlines inside quotes; the first
+        # row yielded is the header
+        yield from csv.reader(codecs.iterdecode(r, "utf-8", errors="replace"))
 
 
 def export_subset(outdir, subset, split):
     os.makedirs(outdir, exist_ok=True)
     url = f"{BASE}/{subset}/{split}.csv"
-    selector = SELECTORS[subset]
     out_path = os.path.join(outdir, f"{subset}-{split}.jsonl")
     ok, skipped = 0, 0
+    error = None
+    batch = []
     with open(out_path, "w", encoding="utf-8") as out:
         try:
-            for row in stream_csv(url):
+            rows = stream_csv(url)
+            # an empty CSV has no header and, like DictReader, no records
+            header = next(rows, [])
+            selector = SELECTORS[subset]({name: i for i, name in enumerate(header)})
+            for row in rows:
+                if not row:
+                    # blank line, not a record
+                    continue
                 try:
-                    if not row or all(v == "" for v in row.values()):
+                    # DictReader pads short rows with None and collects extra
+                    # cells in a list, so only full-width rows count as empty
+                    if len(row) == len(header) and all(v == "" for v in row):
                         skipped += 1
                         continue
                     rec = {"subset": subset, "split": split, **selector(row)}
@@ -70,23 +121,33 @@ def export_subset(outdir, subset, split):
                     if "label" in rec and rec["label"] not in (0, 1, 2, 3, 4, 5):
                         # some subsets only use 0/1; adjust if needed
                         pass
-                    json.dump(rec, out, ensure_ascii=False)
-                    out.write("\n")
+                    batch.append(encode(rec))
                     ok += 1
+                    if len(batch) >= WRITE_BATCH:
+                        out.write("\n".join(batch) + "\n")
+                        batch.clear()
                 except Exception:
                     skipped += 1
         except Exception as e:
-            print(f"skip {subset}/{split}: {e}", file=sys.stderr)
-    print(f"wrote {out_path}  ok={ok} skipped={skipped}")
+            error = f"skip {subset}/{split}: {e}"
+        if batch:
+            out.write("\n".join(batch) + "\n")
+    return error, f"wrote {out_path}  ok={ok} skipped={skipped}"
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--out", required=True)
+    ap.add_argument("--workers", type=int, default=8)
     args = ap.parse_args()
-    for subset in SELECTORS:
-        for split in ("train", "test", "test_hard"):
-            export_subset(args.out, subset, split)
+    jobs = [(subset, split) for subset in SELECTORS for split in ("train", "test", "test_hard")]
+    # downloads are network-bound and each writes its own file, so threads suffice
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        # report from the main thread, in job order, so lines never interleave
+        for error, summary in pool.map(lambda job: export_subset(args.out, *job), jobs):
+            if error:
+                print(error, file=sys.stderr)
+            print(summary)
 
 
 if __name__ == "__main__":
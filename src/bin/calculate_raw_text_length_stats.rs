@@ -1,19 +1,23 @@
 use std::collections::BTreeMap;
-use std::fs::File;
-use std::io::{BufRead, BufReader};
 use std::path::{Path, PathBuf};
+use std::thread;
+use std::time::UNIX_EPOCH;
 
 use anyhow::{Context, Result};
 use clap::Parser;
+use ethics_pipeline::jsonl::{lines, text_field, trim, Text};
+use ethics_pipeline::parallel::map_ordered;
 use glob::glob;
-use serde::Serialize;
-use serde_json::Value;
+use serde::{Deserialize, Serialize};
 use tracing::{info, warn};
 
 /// Newtype for text length in bytes.
 #[derive(Debug, Clone, Copy)]
 struct TextLen(usize);
 
+/// Bump when the cached per-file data changes meaning or shape.
+const CACHE_VERSION: u32 = 2;
+
 /// Per-file / overall statistics.
 #[derive(Debug, Clone, Serialize)]
 struct Stats {
@@ -34,8 +38,8 @@ struct Report {
     files: BTreeMap<String, Stats>,
 }
 
-/// Streaming aggregator for overall stats (mean/std/min/max).
-#[derive(Debug, Default)]
+/// Streaming aggregator for mean/std/min/max.
+#[derive(Debug, Clone, Default, Serialize, Deserialize)]
 struct RunningStats {
     count: usize,
     mean: f64,
@@ -60,7 +64,34 @@ impl RunningStats {
         self.m2 += delta * delta2;
     }
 
-    fn finalize(self, p25: Option<f64>, p50: Option<f64>, p75: Option<f64>) -> Stats {
+    /// Fold another accumulator into this one using Chan et al.'s pairwise
+    /// combination, so partial results never need their raw lengths.
+    fn merge(&mut self, other: &RunningStats) {
+        if other.count == 0 {
+            return;
+        }
+        if self.count == 0 {
+            *self = other.clone();
+            return;
+        }
+
+        let n_a = self.count as f64;
+        let n_b = other.count as f64;
+        let n = n_a + n_b;
+        let delta = other.mean - self.mean;
+        self.mean += delta * n_b / n;
+        self.m2 += other.m2 + delta * delta * n_a * n_b / n;
+        self.count += other.count;
+
+        if let Some(m) = other.min {
+            self.min = Some(self.min.map_or(m, |cur| cur.min(m)));
+        }
+        if let Some(m) = other.max {
+            self.max = Some(self.max.map_or(m, |cur| cur.max(m)));
+        }
+    }
+
+    fn finalize(&self, p25: Option<f64>, p50: Option<f64>, p75: Option<f64>) -> Stats {
         if self.count == 0 {
             return Stats {
                 count: 0,
@@ -93,6 +124,118 @@ impl RunningStats {
     }
 }
 
+/// Exact length histogram: `counts[len]` is how many texts had that length.
+/// Memory is bounded by the longest text rather than the number of records,
+/// and histograms from different files merge by adding bins.
+#[derive(Debug, Clone, Default, Serialize, Deserialize)]
+struct LengthHistogram {
+    #[serde(with = "sparse_counts")]
+    counts: Vec<u64>,
+}
+
+/// Serde adapter storing a dense histogram as a `length -> count` map of its
+/// nonzero bins, so one very long text costs one cache entry, not millions
+/// of zeros.
+mod sparse_counts {
+    use std::collections::BTreeMap;
+
+    use serde::{Deserialize, Deserializer, Serializer};
+
+    pub fn serialize<S: Serializer>(counts: &[u64], serializer: S) -> Result<S::Ok, S::Error> {
+        serializer.collect_map(counts.iter().enumerate().filter(|&(_, &c)| c != 0))
+    }
+
+    pub fn deserialize<'de, D: Deserializer<'de>>(deserializer: D) -> Result<Vec<u64>, D::Error> {
+        let bins = BTreeMap::<usize, u64>::deserialize(deserializer)?;
+        let mut counts = vec![0; bins.last_key_value().map_or(0, |(&len, _)| len + 1)];
+        for (len, c) in bins {
+            counts[len] = c;
+        }
+        Ok(counts)
+    }
+}
+
+impl LengthHistogram {
+    fn push(&mut self, len: TextLen) {
+        if len.0 >= self.counts.len() {
+            self.counts.resize(len.0 + 1, 0);
+        }
+        self.counts[len.0] += 1;
+    }
+
+    fn merge(&mut self, other: &LengthHistogram) {
+        if other.counts.len() > self.counts.len() {
+            self.counts.resize(other.counts.len(), 0);
+        }
+        for (a, b) in self.counts.iter_mut().zip(&other.counts) {
+            *a += b;
+        }
+    }
+
+    /// Linear-interpolated percentiles for each of `qs`. Every order
+    /// statistic involved is resolved in a single walk over the cumulative
+    /// counts, rather than one walk per quantile.
+    fn percentiles<const K: usize>(&self, qs: [f64; K]) -> [Option<f64>; K] {
+        let n: u64 = self.counts.iter().sum();
+        if n == 0 {
+            return [None; K];
+        }
+
+        // (lower rank, upper rank, fraction) per quantile.
+        let spans = qs.map(|q| {
+            let idx = q * (n as f64 - 1.0);
+            let lo = idx.floor() as u64;
+            (lo, (lo + 1).min(n - 1), idx - lo as f64)
+        });
+
+        let mut ranks: Vec<u64> = spans.iter().flat_map(|&(lo, hi, _)| [lo, hi]).collect();
+        ranks.sort_unstable();
+        ranks.dedup();
+
+        let mut values = Vec::with_capacity(ranks.len());
+        let mut bins = self.counts.iter().enumerate();
+        let (mut seen, mut current) = (0, 0);
+        for &rank in &ranks {
+            while seen <= rank {
+                let Some((len, &c)) = bins.next() else {
+                    break;
+                };
+                seen += c;
+                current = len;
+            }
+            values.push(current as f64);
+        }
+
+        let value = |rank| values[ranks.binary_search(&rank).expect("rank was resolved")];
+        spans.map(|(lo, hi, frac)| Some(value(lo) * (1.0 - frac) + value(hi) * frac))
+    }
+}
+
+/// What the cache compares to decide whether a file changed since the run
+/// that produced its entry.
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Serialize, Deserialize)]
+struct Fingerprint {
+    size: u64,
+    mtime_ns: Option<u64>,
+}
+
+/// Everything a worker hands back for one input file; also what the cache
+/// stores per input path.
+#[derive(Debug, Clone, Serialize, Deserialize)]
+struct FileResult {
+    name: String,
+    fingerprint: Fingerprint,
+    running: RunningStats,
+    histogram: LengthHistogram,
+}
+
+/// On-disk cache of per-file results, keyed by input path.
+#[derive(Debug, Default, Serialize, Deserialize)]
+struct StatsCache {
+    version: u32,
+    files: BTreeMap<String, FileResult>,
+}
+
 /// CLI arguments.
 #[derive(Parser, Debug)]
 #[command(
@@ -113,102 +256,131 @@ struct Args {
         value_name = "OUT"
     )]
     out: String,
-}
-
-fn lengths_from_jsonl(path: &Path) -> Result<Vec<TextLen>> {
-    let file = File::open(path)
-        .with_context(|| format!("failed to open JSONL file {}", path.display()))?;
-    let reader = BufReader::new(file);
 
-    let mut out = Vec::new();
+    /// Per-file results from earlier runs; inputs whose size and mtime are
+    /// unchanged are not re-read.
+    #[arg(long, default_value = "data/stats/.cache.json", value_name = "CACHE")]
+    cache: String,
 
-    for line_result in reader.lines() {
-        let line = line_result
-            .with_context(|| format!("error reading line from {}", path.display()))?;
-        let trimmed = line.trim();
-        if trimmed.is_empty() {
-            continue;
-        }
-
-        let obj: Value = match serde_json::from_str(trimmed) {
-            Ok(v) => v,
-            Err(_) => {
-                continue;
-            }
-        };
+    /// Neither read nor update the cache.
+    #[arg(long)]
+    no_cache: bool,
+}
 
-        if let Some(text) = obj.get("text").and_then(|v| v.as_str()) {
+/// Read one JSONL file and fold every text length straight into the Welford
+/// accumulator and the percentile histogram, so no list of lengths is built.
+fn scan_file(path: &Path) -> Result<(RunningStats, LengthHistogram)> {
+    // One bulk read; each line is scanned in place for its `text` field
+    // instead of allocating a String and a full serde_json::Value.
+    let data = std::fs::read(path)
+        .with_context(|| format!("failed to read JSONL file {}", path.display()))?;
+
+    let mut running = RunningStats::default();
+    let mut histogram = LengthHistogram::default();
+
+    for line in lines(&data) {
+        // Blank, malformed and text-less lines are skipped. Lines are trimmed
+        // as in the prune step, so both tools see the same records.
+        if let Text::Found(text) = text_field(trim(line)) {
             // Use byte length for efficiency; suitable proxy for token count here.
-            let len = text.len();
-            out.push(TextLen(len));
+            let len = TextLen(text.len());
+            running.push(len);
+            histogram.push(len);
         }
     }
 
-    Ok(out)
+    Ok((running, histogram))
 }
 
-fn percentile(sorted_vals: &[TextLen], q: f64) -> Option<f64> {
-    if sorted_vals.is_empty() {
-        return None;
-    }
-    let n = sorted_vals.len();
-    if n == 1 {
-        return Some(sorted_vals[0].0 as f64);
-    }
-
-    let idx = q * (n as f64 - 1.0);
-    let lo = idx.floor() as usize;
-    let hi = (lo + 1).min(n - 1);
-    let frac = idx - lo as f64;
-
-    let lo_val = sorted_vals[lo].0 as f64;
-    let hi_val = sorted_vals[hi].0 as f64;
+/// Final statistics for one file or the merged total; percentiles come from
+/// the histogram.
+fn summarize(running: &RunningStats, histogram: &LengthHistogram) -> Stats {
+    let [p25, p50, p75] = histogram.percentiles([0.25, 0.50, 0.75]);
+    running.finalize(p25, p50, p75)
+}
 
-    Some(lo_val * (1.0 - frac) + hi_val * frac)
+fn fingerprint(path: &Path) -> Result<Fingerprint> {
+    let meta = std::fs::metadata(path)
+        .with_context(|| format!("failed to stat {}", path.display()))?;
+    let mtime_ns = meta
+        .modified()
+        .ok()
+        .and_then(|t| t.duration_since(UNIX_EPOCH).ok())
+        .and_then(|d| u64::try_from(d.as_nanos()).ok());
+
+    Ok(Fingerprint {
+        size: meta.len(),
+        mtime_ns,
+    })
 }
 
-fn summarize_per_file(vals: &[TextLen]) -> Stats {
-    if vals.is_empty() {
-        return Stats {
-            count: 0,
-            min: None,
-            max: None,
-            mean: None,
-            std: None,
-            p25: None,
-            p50: None,
-            p75: None,
-        };
+fn process_file(path: &Path, cache: &StatsCache) -> Result<FileResult> {
+    let fingerprint = fingerprint(path)?;
+    // Without an mtime the size alone is too weak to trust.
+    if fingerprint.mtime_ns.is_some() {
+        if let Some(hit) = cache
+            .files
+            .get(&path.display().to_string())
+            .filter(|hit| hit.fingerprint == fingerprint)
+        {
+            info!("Using cached stats for {}", path.display());
+            return Ok(hit.clone());
+        }
     }
 
-    let mut s = vals.to_vec();
-    s.sort_unstable_by_key(|x| x.0);
+    info!("Processing {}", path.display());
+    let (running, histogram) = scan_file(path)?;
+
+    let name = path
+        .file_name()
+        .unwrap_or_default()
+        .to_string_lossy()
+        .to_string();
+
+    Ok(FileResult {
+        name,
+        fingerprint,
+        running,
+        histogram,
+    })
+}
 
-    let n = s.len();
-    let sum: f64 = s.iter().map(|&x| x.0 as f64).sum();
-    let mean = sum / n as f64;
+/// Load the cache, treating a missing, unreadable or outdated file as empty.
+fn load_cache(path: &Path) -> StatsCache {
+    let Ok(bytes) = std::fs::read(path) else {
+        return StatsCache::default();
+    };
 
-    let var = if n > 1 {
-        let mut acc = 0.0;
-        for &x in &s {
-            let dx = x.0 as f64 - mean;
-            acc += dx * dx;
+    match serde_json::from_slice::<StatsCache>(&bytes) {
+        Ok(cache) if cache.version == CACHE_VERSION => cache,
+        Ok(_) => {
+            info!("Ignoring cache {} from another version", path.display());
+            StatsCache::default()
         }
-        acc / (n as f64 - 1.0)
-    } else {
-        0.0
-    };
+        Err(e) => {
+            warn!("Ignoring unreadable cache {}: {e}", path.display());
+            StatsCache::default()
+        }
+    }
+}
 
-    Stats {
-        count: n,
-        min: Some(s[0].0 as f64),
-        max: Some(s[n - 1].0 as f64),
-        mean: Some(mean),
-        std: Some(var.sqrt()),
-        p25: percentile(&s, 0.25),
-        p50: percentile(&s, 0.50),
-        p75: percentile(&s, 0.75),
+fn save_cache(path: &Path, cache: &StatsCache) -> Result<()> {
+    if let Some(parent) = path.parent() {
+        std::fs::create_dir_all(parent)
+            .with_context(|| format!("failed to create parent dir {}", parent.display()))?;
     }
+    let json = serde_json::to_vec(cache).context("failed to serialize stats cache")?;
+    std::fs::write(path, json)
+        .with_context(|| format!("failed to write stats cache to {}", path.display()))
+}
+
+/// Run `process_file` over `files` on up to one thread per core. Results
+/// come back in input order so the merge below stays deterministic.
+fn process_files(files: &[PathBuf], cache: &StatsCache) -> Result<Vec<FileResult>> {
+    let workers = thread::available_parallelism().map_or(1, |n| n.get());
+    map_ordered(files, workers, |path| process_file(path, cache))
+        .into_iter()
+        .collect()
 }
 
 fn run(args: Args) -> Result<()> {
@@ -228,36 +400,29 @@ fn run(args: Args) -> Result<()> {
     }
 
     let mut file_stats: BTreeMap<String, Stats> = BTreeMap::new();
-    let mut overall_lengths: Vec<TextLen> = Vec::new();
+    let mut overall_histogram = LengthHistogram::default();
     let mut overall_running = RunningStats::default();
 
-    for path in &files {
-        info!("Processing {}", path.display());
-        let lens = lengths_from_jsonl(path)?;
-        let stats = summarize_per_file(&lens);
-
-        // Add per-file stats.
-        let fname = path
-            .file_name()
-            .unwrap_or_default()
-            .to_string_lossy()
-            .to_string();
-        file_stats.insert(fname, stats);
-
-        // Feed lengths into overall running stats + global vector for percentiles.
-        for len in &lens {
-            overall_running.push(*len);
-        }
-        overall_lengths.extend(lens);
-    }
+    let cache_path = PathBuf::from(&args.cache);
+    let mut cache = if args.no_cache {
+        StatsCache::default()
+    } else {
+        load_cache(&cache_path)
+    };
 
-    // Compute overall percentiles once, from sorted global lengths.
-    overall_lengths.sort_unstable_by_key(|x| x.0);
-    let p25 = percentile(&overall_lengths, 0.25);
-    let p50 = percentile(&overall_lengths, 0.50);
-    let p75 = percentile(&overall_lengths, 0.75);
+    let results = process_files(&files, &cache)?;
+    for result in &results {
+        file_stats.insert(
+            result.name.clone(),
+            summarize(&result.running, &result.histogram),
+        );
+
+        // Merge per-file moments and histograms; no raw lengths are pooled.
+        overall_running.merge(&result.running);
+        overall_histogram.merge(&result.histogram);
+    }
 
-    let overall = overall_running.finalize(p25, p50, p75);
+    let overall = summarize(&overall_running, &overall_histogram);
 
     // Build and write report.
     let report = Report {
@@ -282,6 +447,20 @@ fn run(args: Args) -> Result<()> {
         report.files.len()
     );
 
+    if !args.no_cache {
+        // Entries for other existing paths are kept as they were; entries for
+        // deleted or renamed inputs are dropped so the cache does not grow
+        // without bound.
+        cache.version = CACHE_VERSION;
+        cache.files.retain(|path, _| Path::new(path).exists());
+        for (path, result) in files.iter().zip(results) {
+            cache.files.insert(path.display().to_string(), result);
+        }
+        if let Err(e) = save_cache(&cache_path, &cache) {
+            warn!("{e:#}");
+        }
+    }
+
     Ok(())
 }
 
@@ -1,24 +1,217 @@
+use std::collections::hash_map::Entry;
+use std::collections::HashMap;
 use std::env;
 use std::fs::{self, File};
-use std::io::{BufRead, BufReader, BufWriter, Write};
+use std::io::{self, BufRead, BufReader, BufWriter, Write};
 use std::path::{Path, PathBuf};
+use std::thread;
 
+use ethics_pipeline::jsonl::{lines, text_field, trim, Text};
+use ethics_pipeline::parallel::map_ordered;
 use glob::glob;
-use serde_json::Value;
 
 const CUTOFF: usize = 1000;
 const COMMONSENSE_GLOB: &str = "data/raw/commonsense-*.jsonl";
 const OUTDIR: &str = "data/filtered";
+/// Files at least this large are read whole and split into line-aligned
+/// chunks that are filtered on separate threads, when there are spare cores.
+/// Smaller files are streamed line by line.
+const PARALLEL_FILE_BYTES: u64 = 64 * 1024 * 1024;
 
-fn keep(record: &Value) -> bool {
-    let Some(text) = record.get("text").and_then(|v| v.as_str()) else {
+type BoxError = Box<dyn std::error::Error + Send + Sync>;
+
+/// Kept and dropped record counts for a file or a chunk of one.
+#[derive(Debug, Default)]
+struct Pruned {
+    kept: usize,
+    dropped: usize,
+}
+
+impl Pruned {
+    /// Filter one input line, writing it (trimmed, newline-terminated) to
+    /// `out` if it is kept.
+    fn line(&mut self, line: &[u8], out: &mut impl Write) -> io::Result<()> {
+        // text_field validates UTF-8 itself, so the line is not converted
+        // to a str here just to trim it.
+        let trimmed = trim(line);
+        if trimmed.is_empty() {
+            return Ok(());
+        }
+
+        // Records without a string `text` are dropped; invalid JSON is skipped.
+        let keep_line = match text_field(trimmed) {
+            Text::Found(text) => keep(&text),
+            Text::Absent => false,
+            Text::Invalid => return Ok(()),
+        };
+
+        if keep_line {
+            out.write_all(trimmed)?;
+            out.write_all(b"\n")?;
+            self.kept += 1;
+        } else {
+            self.dropped += 1;
+        }
+        Ok(())
+    }
+
+    fn merge(&mut self, other: &Pruned) {
+        self.kept += other.kept;
+        self.dropped += other.dropped;
+    }
+}
+
+/// What happened to one input path, reported once every file is done.
+#[derive(Debug)]
+enum Outcome {
+    /// Written to `OUTDIR`; the line to print on stdout.
+    Pruned(String),
+    /// Not processed; the reason to print on stderr.
+    Skipped(String),
+}
+
+fn keep(text: &str) -> bool {
+    // `text` is already a valid str, so str::trim is used here;
+    // `jsonl::trim` is only for raw input lines.
+    let text = text.trim().as_bytes();
+    // A char is 1-4 UTF-8 bytes, so the byte length bounds the char count
+    // from both sides; only texts in between need their code points counted.
+    if text.len() <= CUTOFF {
+        return true;
+    }
+    if text.len() > 4 * CUTOFF {
         return false;
+    }
+    // Every code point starts with exactly one non-continuation byte.
+    text.iter().filter(|&&b| (b as i8) >= -0x40).count() <= CUTOFF
+}
+
+/// Filter `reader` into `out` line by line, holding one read buffer at a time.
+fn prune_stream(mut reader: impl BufRead, out: &mut impl Write) -> io::Result<Pruned> {
+    let mut pruned = Pruned::default();
+    let mut partial = Vec::new();
+
+    loop {
+        let block = reader.fill_buf()?;
+        if block.is_empty() {
+            break;
+        }
+
+        // Whole lines are filtered straight out of the read buffer; only a
+        // line that runs past the end of it is copied out with read_until.
+        let used = match memchr::memrchr(b'\n', block) {
+            Some(i) => {
+                for line in lines(&block[..i]) {
+                    pruned.line(line, out)?;
+                }
+                i + 1
+            }
+            None => {
+                reader.read_until(b'\n', &mut partial)?;
+                pruned.line(&partial, out)?;
+                partial.clear();
+                0
+            }
+        };
+        reader.consume(used);
+    }
+
+    Ok(pruned)
+}
+
+/// Filter an in-memory chunk, returning its kept lines with the counts.
+fn prune_chunk(chunk: &[u8]) -> (Vec<u8>, Pruned) {
+    let mut out = Vec::new();
+    let mut pruned = Pruned::default();
+
+    for line in lines(chunk) {
+        pruned
+            .line(line, &mut out)
+            .expect("writing to a Vec cannot fail");
+    }
+
+    (out, pruned)
+}
+
+/// Split `buf` into roughly `parts` pieces, each ending just after a newline
+/// (or at the end of the buffer), so no line straddles two pieces.
+fn line_aligned_chunks(buf: &[u8], parts: usize) -> Vec<&[u8]> {
+    let target = buf.len().div_ceil(parts.max(1)).max(1);
+    let mut chunks = Vec::with_capacity(parts);
+    let mut start = 0;
+
+    while start < buf.len() {
+        let end = (start + target).min(buf.len());
+        let end = match memchr::memchr(b'\n', &buf[end..]) {
+            Some(i) => end + i + 1,
+            None => buf.len(),
+        };
+        chunks.push(&buf[start..end]);
+        start = end;
+    }
+
+    chunks
+}
+
+/// Filter a whole file's contents on `parts` threads.
+fn prune_parallel(buf: &[u8], parts: usize, out: &mut impl Write) -> io::Result<Pruned> {
+    let chunks = line_aligned_chunks(buf, parts);
+
+    // Chunks are filtered independently and written back in order, so the
+    // output is identical to a sequential pass.
+    let results = map_ordered(&chunks, parts, |chunk| prune_chunk(chunk));
+
+    let mut pruned = Pruned::default();
+    for (chunk_out, chunk_pruned) in &results {
+        out.write_all(chunk_out)?;
+        pruned.merge(chunk_pruned);
+    }
+    Ok(pruned)
+}
+
+/// Where the pruned copy of `inpath` is written, or `None` if the path has
+/// no file name.
+fn output_path(inpath: &Path) -> Option<PathBuf> {
+    inpath.file_name().map(|name| Path::new(OUTDIR).join(name))
+}
+
+/// Prune one file into `OUTDIR`, splitting it over `threads` threads if it
+/// is large enough to be worth it.
+fn prune_file(inpath: &Path, threads: usize) -> Result<Outcome, BoxError> {
+    if !inpath.exists() {
+        return Ok(Outcome::Skipped(format!(
+            "skip: {} not found",
+            inpath.display()
+        )));
+    }
+
+    let Some(outpath) = output_path(inpath) else {
+        return Ok(Outcome::Skipped(format!(
+            "skip: {} has no file name",
+            inpath.display()
+        )));
     };
 
-    text.trim().chars().count() <= CUTOFF
+    let mut writer = BufWriter::new(File::create(&outpath)?);
+
+    let pruned = if threads > 1 && fs::metadata(inpath)?.len() >= PARALLEL_FILE_BYTES {
+        let data = fs::read(inpath)?;
+        prune_parallel(&data, threads, &mut writer)?
+    } else {
+        prune_stream(BufReader::new(File::open(inpath)?), &mut writer)?
+    };
+    writer.flush()?;
+
+    Ok(Outcome::Pruned(format!(
+        "{}: kept={} dropped={} -> {}",
+        inpath.file_name().unwrap_or_default().to_string_lossy(),
+        pruned.kept,
+        pruned.dropped,
+        outpath.display()
+    )))
 }
 
-fn main() -> Result<(), Box<dyn std::error::Error>> {
+fn main() -> Result<(), BoxError> {
     fs::create_dir_all(OUTDIR)?;
 
     let args: Vec<String> = env::args().skip(1).collect();
@@ -35,66 +228,50 @@ fn main() -> Result<(), Box<dyn std::error::Error>> {
         args.into_iter().map(PathBuf::from).collect()
     };
 
-    for inpath in input_paths {
-        if !inpath.exists() {
-            eprintln!("skip: {} not found", inpath.display());
+    // Inputs that write the same output file (same file name, or the same
+    // path given twice) form one group, pruned in input order by a single
+    // worker, so the last one wins as in a sequential run instead of two
+    // workers writing the file at once.
+    let mut groups: Vec<Vec<usize>> = Vec::new();
+    let mut group_of: HashMap<PathBuf, usize> = HashMap::new();
+    for (i, inpath) in input_paths.iter().enumerate() {
+        let Some(outpath) = output_path(inpath) else {
+            groups.push(vec![i]);
             continue;
-        }
-
-        let file_name = match inpath.file_name() {
-            Some(name) => name.to_os_string(),
-            None => {
-                eprintln!("skip: {} has no file name", inpath.display());
-                continue;
-            }
         };
-
-        let outpath = Path::new(OUTDIR).join(file_name);
-
-        let fin = File::open(&inpath)?;
-        let reader = BufReader::new(fin);
-
-        let fout = File::create(&outpath)?;
-        let mut writer = BufWriter::new(fout);
-
-        let mut kept: usize = 0;
-        let mut dropped: usize = 0;
-
-        for line_result in reader.lines() {
-            let line = line_result?;
-            let trimmed = line.trim();
-            if trimmed.is_empty() {
-                continue;
-            }
-
-            let record: Value = match serde_json::from_str(trimmed) {
-                Ok(v) => v,
-                Err(_) => {
-                    continue;
-                }
-            };
-
-            if keep(&record) {
-                writer.write_all(trimmed.as_bytes())?;
-                writer.write_all(b"\n")?;
-                kept += 1;
-            } else {
-                dropped += 1;
+        match group_of.entry(outpath) {
+            Entry::Occupied(group) => groups[*group.get()].push(i),
+            Entry::Vacant(slot) => {
+                slot.insert(groups.len());
+                groups.push(vec![i]);
             }
         }
+    }
 
-        writer.flush()?;
-
-        println!(
-            "{}: kept={} dropped={} -> {}",
-            inpath
-                .file_name()
-                .unwrap_or_default()
-                .to_string_lossy(),
-            kept,
-            dropped,
-            outpath.display()
-        );
+    // Groups are independent: fan them out over up to one thread per core,
+    // each worker claiming the next unprocessed group. Cores left over when
+    // there are fewer groups than cores go to splitting large files.
+    let cores = thread::available_parallelism().map_or(1, |n| n.get());
+    let workers = cores.min(groups.len());
+    let threads_per_file = cores / workers.max(1);
+    let mut outcomes: Vec<(usize, Result<Outcome, BoxError>)> =
+        map_ordered(&groups, workers, |group| {
+            group
+                .iter()
+                .map(|&i| (i, prune_file(&input_paths[i], threads_per_file)))
+                .collect::<Vec<_>>()
+        })
+        .into_iter()
+        .flatten()
+        .collect();
+    outcomes.sort_by_key(|&(i, _)| i);
+
+    // Report in input order, whichever worker finished first.
+    for (_, outcome) in outcomes {
+        match outcome? {
+            Outcome::Pruned(summary) => println!("{summary}"),
+            Outcome::Skipped(reason) => eprintln!("{reason}"),
+        }
     }
 
     Ok(())
@@ -0,0 +1,215 @@
+//! Lookup of the `text` field in JSONL records.
+//!
+//! The length tools only need one field per record, so lines are
+//! deserialized into a record that borrows just `text` and skips every other
+//! key. Lines that record rejects (duplicate keys, a non-string `text`) are
+//! re-parsed as a full `serde_json::Value`, so they are handled exactly as a
+//! plain `Value` parse would handle them.
+//!
+//! Skipped strings are not decoded, so an unpaired `\uD800`-style escape
+//! outside `text` is accepted here where a `Value` parse would reject the
+//! line. The exporter never writes one, and looking for them would cost
+//! another pass over every line.
+
+use std::borrow::Cow;
+
+use serde::Deserialize;
+use serde_json::Value;
+
+/// The only field we measure; every other key in a record is skipped
+/// without being materialized.
+#[derive(Debug, Deserialize)]
+struct TextRecord<'a> {
+    #[serde(borrow, default)]
+    text: Option<BorrowedStr<'a>>,
+}
+
+/// `#[serde(borrow)]` only borrows a bare `Cow<str>`; inside an `Option`
+/// serde falls back to the generic `Cow` impl, which always allocates. The
+/// newtype keeps the borrowing impl.
+#[derive(Debug, Deserialize)]
+struct BorrowedStr<'a>(#[serde(borrow)] Cow<'a, str>);
+
+/// Result of looking up the top-level `text` field of one line.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub enum Text<'a> {
+    /// `text` is a string. Borrowed from the line unless it contained escapes.
+    Found(Cow<'a, str>),
+    /// Valid JSON, but no top-level string `text` field.
+    Absent,
+    /// Not valid JSON.
+    Invalid,
+}
+
+/// Split a JSONL buffer on `\n`, like `buf.split(|&b| b == b'\n')` but
+/// finding each newline with memchr's vectorized search instead of testing
+/// every byte.
+pub fn lines(buf: &[u8]) -> Lines<'_> {
+    Lines { rest: Some(buf) }
+}
+
+/// Iterator returned by [`lines`].
+#[derive(Debug, Clone)]
+pub struct Lines<'a> {
+    rest: Option<&'a [u8]>,
+}
+
+impl<'a> Iterator for Lines<'a> {
+    type Item = &'a [u8];
+
+    fn next(&mut self) -> Option<&'a [u8]> {
+        let rest = self.rest?;
+        match memchr::memchr(b'\n', rest) {
+            Some(i) => {
+                self.rest = Some(&rest[i + 1..]);
+                Some(&rest[..i])
+            }
+            None => self.rest.take(),
+        }
+    }
+}
+
+/// The ASCII bytes `str::trim` strips (`\t`..=`\r` and space), as a lookup
+/// table so the trim loops test each byte with a single load.
+const ASCII_WS: [bool; 256] = {
+    let mut table = [false; 256];
+    table[b' ' as usize] = true;
+    let mut b = b'\t';
+    while b <= b'\r' {
+        table[b as usize] = true;
+        b += 1;
+    }
+    table
+};
+
+/// Trim a raw JSONL line before `text_field`; both length tools use this so
+/// they agree on which lines hold records.
+///
+/// `str::trim` on raw bytes, without validating them as UTF-8 first. ASCII
+/// whitespace is stripped via `ASCII_WS`; only input that still starts or
+/// ends with a non-ASCII byte (possibly Unicode whitespace) takes the str
+/// path.
+pub fn trim(bytes: &[u8]) -> &[u8] {
+    let start = bytes
+        .iter()
+        .position(|&b| !ASCII_WS[b as usize])
+        .unwrap_or(bytes.len());
+    let end = bytes
+        .iter()
+        .rposition(|&b| !ASCII_WS[b as usize])
+        .map_or(start, |i| i + 1);
+    let trimmed = &bytes[start..end];
+
+    match (trimmed.first(), trimmed.last()) {
+        (Some(&first), Some(&last)) if !first.is_ascii() || !last.is_ascii() => {
+            std::str::from_utf8(trimmed).map_or(trimmed, |s| s.trim().as_bytes())
+        }
+        _ => trimmed,
+    }
+}
+
+/// Look up the top-level `"text"` string of one JSONL line.
+pub fn text_field(line: &[u8]) -> Text<'_> {
+    // A derived struct also accepts a JSON array positionally, so only
+    // objects take the borrowed path.
+    if line.trim_ascii_start().first() != Some(&b'{') {
+        return parse_full(line);
+    }
+
+    // Validate UTF-8 once up front: it also covers skipped strings, which
+    // serde_json would otherwise not decode, and it is faster than letting
+    // `from_slice` check each borrowed string.
+    let Ok(line_str) = std::str::from_utf8(line) else {
+        return Text::Invalid;
+    };
+    match serde_json::from_str::<TextRecord>(line_str) {
+        Ok(TextRecord {
+            text: Some(BorrowedStr(text)),
+        }) => Text::Found(text),
+        Ok(TextRecord { text: None }) => Text::Absent,
+        Err(_) => parse_full(line),
+    }
+}
+
+fn parse_full(line: &[u8]) -> Text<'_> {
+    match serde_json::from_slice::<Value>(line) {
+        Ok(Value::Object(mut obj)) => match obj.remove("text") {
+            Some(Value::String(text)) => Text::Found(Cow::Owned(text)),
+            _ => Text::Absent,
+        },
+        Ok(_) => Text::Absent,
+        Err(_) => Text::Invalid,
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn plain_text_is_borrowed() {
+        let line = br#"{"subset":"x","text":"plain ascii"}"#;
+        assert!(matches!(
+            text_field(line),
+            Text::Found(Cow::Borrowed("plain ascii"))
+        ));
+    }
+
+    #[test]
+    fn escaped_text_is_decoded() {
+        let line = br#"{"text":"a\"b\u00e9"}"#;
+        assert_eq!(
+            text_field(line),
+            Text::Found(Cow::Owned("a\"b\u{e9}".into()))
+        );
+    }
+
+    #[test]
+    fn duplicate_text_key_is_last_wins() {
+        let line = br#"{"text":"first","text":"second"}"#;
+        assert_eq!(text_field(line), Text::Found("second".into()));
+    }
+
+    #[test]
+    fn non_string_text_and_arrays_are_absent() {
+        assert_eq!(text_field(br#"{"text":1}"#), Text::Absent);
+        assert_eq!(text_field(br#"{"text":null}"#), Text::Absent);
+        assert_eq!(text_field(br#"{"label":0}"#), Text::Absent);
+        assert_eq!(text_field(br#"["text"]"#), Text::Absent);
+    }
+
+    #[test]
+    fn bad_utf8_and_bad_json_are_invalid() {
+        assert_eq!(
+            text_field(b"{\"a\":\"\xff\",\"text\":\"x\"}"),
+            Text::Invalid
+        );
+        assert_eq!(text_field(b"{\"text\":\"\xc3\"}"), Text::Invalid);
+        assert_eq!(text_field(br#"{"text":"x""#), Text::Invalid);
+        assert_eq!(text_field(b""), Text::Invalid);
+    }
+
+    #[test]
+    fn trim_matches_str_trim() {
+        for text in [
+            "",
+            " \t\r\n",
+            " {} ",
+            "\u{a0}{\"text\":\"x\"}\u{3000}",
+            "\u{c}x\u{85}",
+            "é",
+        ] {
+            assert_eq!(trim(text.as_bytes()), text.trim().as_bytes());
+        }
+        // Invalid UTF-8 is only stripped of ASCII whitespace.
+        assert_eq!(trim(b" \xff{} "), b"\xff{}");
+    }
+
+    #[test]
+    fn lines_match_split_on_newline() {
+        for buf in [&b""[..], b"a", b"a\n", b"\n\nb\nc", b"a\r\nb\n\n"] {
+            let expected: Vec<&[u8]> = buf.split(|&b| b == b'\n').collect();
+            assert_eq!(lines(buf).collect::<Vec<_>>(), expected);
+        }
+    }
+}
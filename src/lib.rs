@@ -0,0 +1,4 @@
+//! Helpers shared by the pipeline binaries.
+
+pub mod jsonl;
+pub mod parallel;
@@ -0,0 +1,73 @@
+//! Ordered parallel map over independent inputs.
+
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::thread;
+
+/// Apply `f` to every item on up to `workers` scoped threads and return the
+/// results in input order.
+///
+/// Workers claim the next unprocessed index, so a few slow items do not
+/// leave the other threads idle; which worker ran an item has no effect on
+/// where its result lands.
+pub fn map_ordered<T, R, F>(items: &[T], workers: usize, f: F) -> Vec<R>
+where
+    T: Sync,
+    R: Send,
+    F: Fn(&T) -> R + Sync,
+{
+    let workers = workers.clamp(1, items.len().max(1));
+    let next = AtomicUsize::new(0);
+    let mut slots: Vec<Option<R>> = items.iter().map(|_| None).collect();
+
+    thread::scope(|scope| {
+        let handles: Vec<_> = (0..workers)
+            .map(|_| {
+                scope.spawn(|| {
+                    let mut done = Vec::new();
+                    loop {
+                        let i = next.fetch_add(1, Ordering::Relaxed);
+                        let Some(item) = items.get(i) else {
+                            break;
+                        };
+                        done.push((i, f(item)));
+                    }
+                    done
+                })
+            })
+            .collect();
+
+        for handle in handles {
+            for (i, result) in handle.join().expect("worker thread panicked") {
+                slots[i] = Some(result);
+            }
+        }
+    });
+
+    slots
+        .into_iter()
+        .map(|slot| slot.expect("every item is claimed by a worker"))
+        .collect()
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn results_are_in_input_order() {
+        let items: Vec<u64> = (0..100).collect();
+        for workers in [0, 1, 3, 8, 200] {
+            let squares = map_ordered(&items, workers, |&x| {
+                // Uneven work so workers finish out of order.
+                thread::sleep(std::time::Duration::from_micros((100 - x) * 10));
+                x * x
+            });
+            assert_eq!(squares, items.iter().map(|x| x * x).collect::<Vec<_>>());
+        }
+    }
+
+    #[test]
+    fn empty_input() {
+        assert!(map_ordered(&[] as &[u8], 4, |&b| b).is_empty());
+    }
+}